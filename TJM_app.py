@@ -1,68 +1,52 @@
 import streamlit as st
 import pandas as pd
 import os
-from fpdf import FPDF
-from datetime import datetime
+import glob
+from datetime import date
 import math
-import io
-import xlsxwriter
 import copy
+from collections import defaultdict, namedtuple
+from functools import partial
+from types import MappingProxyType
 
 # =======================
 # Helpers
 # =======================
 def _safe_float(val, default=0.0):
+    # float() ya rechaza "", "none" y pd.NA; NaN (también "nan") se detecta con f != f.
+    # OverflowError: enteros demasiado grandes para un float (p. ej. 10**400)
+    if val is None:
+        return default
     try:
-        if val is None:
-            return default
-        if isinstance(val, float) and (pd.isna(val)):
-            return default
-        if isinstance(val, str) and val.strip().lower() in ("", "nan", "none"):
-            return default
-        return float(val)
-    except Exception:
+        f = float(val)
+    except (TypeError, ValueError, OverflowError):
         return default
+    return default if f != f else f
+
+def _fmt_money(valor) -> str:
+    # Pesos sin decimales con separador de miles: 1234567.8 -> "$1,234,567" (trunca, como int())
+    return f"${int(valor):,}"
+
+def _clean_str_col(col: pd.Series, upper: bool = False) -> pd.Series:
+    col = col.fillna("").astype(str).str.strip()
+    return col.str.upper() if upper else col
+
+def _num_col(col: pd.Series, default) -> pd.Series:
+    # _safe_float aplicado a toda una columna: lo no numérico o vacío toma el valor por defecto
+    return pd.to_numeric(col, errors="coerce").fillna(default).astype(float)
 
 def ceil_to_even(x: float) -> int:
-    n = math.ceil(x)
-    return n if n % 2 == 0 else n + 1
+    # Sube al par siguiente sin ramificar: 3 -> 4, 4 -> 4
+    return (math.ceil(x) + 1) & ~1
+
 def get_image_path_for_summary(diseno, tela_info):
     """
     Versión de get_image_path para usar en el resumen de cotización.
     Toma el diseño y la información de la tela como argumentos en lugar de leer el session_state.
     """
-    placeholder = os.path.join(SCRIPT_DIR, "imagenes", "placeholder.png")
-    
-    # Si falta información clave, devuelve el placeholder
-    if not all([diseno, tela_info]):
-        return placeholder
-
-    tipo_tela = tela_info.get('tipo', '')
-    ref = tela_info.get('referencia', '')
-    color = tela_info.get('color', '')
-
-    if not all([tipo_tela, ref, color]):
-        return placeholder
-
-    # Limpiar nombres para coincidir con la estructura de carpetas
-    diseno_cleaned = str(diseno).strip().replace(" ", "_").upper()
-    tipo_tela_cleaned = str(tipo_tela).strip().replace(" ", "_")
-    ref_cleaned = str(ref).strip().replace(" ", "_").replace(".", "")
-    color_cleaned = str(color).strip().replace(" ", "_")
-
-    base_name = f"{tipo_tela_cleaned} - {ref_cleaned} - {color_cleaned}"
-
-    # Rutas candidatas (intenta .jpg y .png)
-    candidates = [
-        os.path.join(SCRIPT_DIR, "imagenes", "cortinas", diseno_cleaned, tipo_tela_cleaned, base_name + ".jpg"),
-        os.path.join(SCRIPT_DIR, "imagenes", "cortinas", diseno_cleaned, tipo_tela_cleaned, base_name + ".png"),
-    ]
-
-    for p in candidates:
-        if os.path.exists(p):
-            return p
-            
-    return placeholder
+    # Sin tela, _resolve_image_path devuelve el placeholder
+    tela_info = tela_info or {}
+    return _resolve_image_path(diseno, tela_info.get('tipo', ''), tela_info.get('referencia', ''), tela_info.get('color', ''))
 # =======================
 # Paths & constants
 # =======================
@@ -79,31 +63,40 @@ REQUIRED_DESIGNS_COLS = ["Diseño", "Tipo", "Multiplicador", "PVP M.O."]
 REQUIRED_BOM_COLS     = ["Diseño", "Insumo", "Unidad", "ReglaCantidad", "Parametro", "DependeDeSeleccion", "Observaciones"]
 REQUIRED_CAT_COLS     = ["Insumo", "Unidad", "Ref", "Color", "PVP"]
 REQUIRED_TELAS_COLS   = ["TipoTela", "Referencia", "Color", "PVP/Metro ($)"]
+# Un renglón del BOM: tupla con nombre en lugar de dict (más liviana y de solo lectura).
+# clave = insumo en mayúsculas, para comparar contra "TELA 1"/"TELA 2"/"M.O" sin normalizar en cada cálculo.
+BomItem = namedtuple("BomItem", "insumo unidad regla parametro depende observaciones parametro_num clave")
 ALLOWED_RULES = {"MT_ANCHO_X_MULT", "UND_OJALES_PAR", "UND_BOTON_PAR", "FIJO"}
 IVA_PERCENT = 0.19
 DISTANCIA_BOTON_DEF = 0.20
 DISTANCIA_OJALES_DEF = 0.14
 
+# Valor de Parametro a usar cuando la celda está vacía o no es numérica
+_RULE_DEFAULTS = {"MT_ANCHO_X_MULT": 1.0, "UND_OJALES_PAR": DISTANCIA_OJALES_DEF, "UND_BOTON_PAR": DISTANCIA_BOTON_DEF, "FIJO": 0.0}
+
+# ReglaCantidad -> cantidad por cortina a partir de (ancho, multiplicador, ParametroNum)
+_RULE_FNS = {
+    "MT_ANCHO_X_MULT": lambda a, m, p: a * m * p,
+    "UND_OJALES_PAR": lambda a, m, p: ceil_to_even((a * m) / p),
+    "UND_BOTON_PAR": lambda a, m, p: ceil_to_even((a * m) / p),
+    "FIJO": lambda a, m, p: p,
+}
+
 # =======================
 # Función para Imagen
 # =======================
-def get_image_path(tela_num):
+@st.cache_data(show_spinner=False, max_entries=512, ttl=300)
+def _resolve_image_path(diseno, tipo_tela, ref, color):
     """
-    Construye la ruta a la imagen de la cortina, considerando el Diseño y la Tela.
-    Si no encuentra una imagen específica, devuelve la ruta a un placeholder.
-
-    Cambios realizados:
-    - Se limpian (normalizan) diseño, tipo de tela, referencia y color para que
-      coincidan con las carpetas/archivos.
-    - Se intenta con extensiones .jpg y .png.
-    - Se usa el tipo de tela LIMPIO en la ruta de carpeta.
+    Resuelve (y memoriza) la ruta de la imagen para una combinación Diseño/Tela,
+    de modo que los reruns no vuelvan a consultar el sistema de archivos.
+    El resultado vence a los 5 minutos, para que aparezcan las imágenes que se
+    agreguen (o quiten) con la app en marcha.
+    Devuelve None si tampoco existe el placeholder.
     """
-    diseno = st.session_state.get("diseno_sel")
-    tipo_tela = st.session_state.get(f"tipo_tela_sel_{tela_num}")
-    ref = st.session_state.get(f"ref_tela_sel_{tela_num}")
-    color = st.session_state.get(f"color_tela_sel_{tela_num}")
-
     placeholder = os.path.join(SCRIPT_DIR, "imagenes", "placeholder.png")
+    if not os.path.exists(placeholder):
+        placeholder = None
 
     # Si falta alguna selección, devuelve el placeholder
     if not all([diseno, tipo_tela, ref, color]):
@@ -130,179 +123,329 @@ def get_image_path(tela_num):
 
     return placeholder
 
+def get_image_path(tela_num):
+    """
+    Construye la ruta a la imagen de la cortina, considerando el Diseño y la Tela.
+    Si no encuentra una imagen específica, devuelve la ruta a un placeholder.
+
+    Cambios realizados:
+    - Se limpian (normalizan) diseño, tipo de tela, referencia y color para que
+      coincidan con las carpetas/archivos.
+    - Se intenta con extensiones .jpg y .png.
+    - Se usa el tipo de tela LIMPIO en la ruta de carpeta.
+    """
+    diseno = st.session_state.get("diseno_sel")
+    tipo_tela = st.session_state.get(f"tipo_tela_sel_{tela_num}")
+    ref = st.session_state.get(f"ref_tela_sel_{tela_num}")
+    color = st.session_state.get(f"color_tela_sel_{tela_num}")
+    return _resolve_image_path(diseno, tipo_tela, ref, color)
+
 # =======================
 # Loading
 # =======================
-@st.cache_data(show_spinner="Cargando datos de diseños...")
-def load_designs_from_excel(path: str):
-    if not os.path.exists(path):
-        st.error(f"No se encontró el archivo Excel de Diseños en: {path}")
+# Los _parse_* son puros y cacheados: ante datos inválidos lanzan ValueError, que los
+# load_* (fuera de la caché) muestran con st.error/st.stop.
+# Se cachean con st.cache_resource: cada rerun recibe el mismo objeto sin copiarlo ni
+# deserializarlo. Son tablas de solo lectura; nadie debe modificarlas.
+# max_entries=1: cada parser lee un solo archivo, así que al cambiar el Excel se libera el catálogo anterior.
+def _file_stamp(path: str):
+    # (mtime en ns, tamaño): se pasa a los parsers como parte de la llave de caché; si el Excel
+    # cambia, se vuelve a leer. El tamaño detecta reemplazos que conservan el mtime (cp -p, rsync -t).
+    # Un solo stat por archivo y rerun; None indica que el archivo no existe.
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_mtime_ns, info.st_size
+
+try:
+    import python_calamine  # noqa: F401
+    _EXCEL_READ_KWARGS = {"engine": "calamine"}
+except ImportError:
+    # Sin calamine: openpyxl en modo solo lectura (streaming), sin fórmulas ni enlaces externos
+    _EXCEL_READ_KWARGS = {"engine": "openpyxl", "engine_kwargs": {"read_only": True, "data_only": True, "keep_links": False}}
+
+def _read_excel(path: str, stamp, usecols, text_cols=()) -> pd.DataFrame:
+    # Solo se leen las columnas requeridas; las de texto se piden como str para que pandas no
+    # infiera tipos en columnas que de todas formas se normalizan como texto.
+    # Copia Parquet junto al Excel, válida mientras su mtime y tamaño no cambien: evita volver a
+    # parsear el Excel tras un reinicio del proceso (la caché de Streamlit solo vive en memoria).
+    mtime_ns, size = stamp
+    cache_path = f"{path}.{mtime_ns}-{size}.parquet"
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_parquet(cache_path, columns=list(usecols))
+        except Exception:
+            pass
+    usecols_set = set(usecols)
+    df = pd.read_excel(path, usecols=lambda c: c in usecols_set, dtype={c: str for c in text_cols}, **_EXCEL_READ_KWARGS)
+    for viejo in glob.glob(glob.escape(path) + ".*.parquet"):
+        try:
+            os.remove(viejo)
+        except OSError:
+            pass
+    try:
+        df.to_parquet(cache_path)
+    except Exception:
+        pass  # La copia es opcional (carpeta de solo lectura, columnas con tipos mezclados, ...)
+    return df
+
+def _load_or_stop(parser, path: str, stamp):
+    try:
+        return parser(path, stamp)
+    except ValueError as e:
+        st.error(str(e))
         st.stop()
-    df = pd.read_excel(path, engine="openpyxl")
+
+@st.cache_resource(show_spinner="Cargando datos de diseños...", max_entries=1)
+def _parse_designs(path: str, stamp):
+    df = _read_excel(path, stamp, REQUIRED_DESIGNS_COLS, text_cols=("Diseño", "Tipo"))
     
-    faltantes = [c for c in REQUIRED_DESIGNS_COLS if c not in df.columns]
+    faltantes = set(REQUIRED_DESIGNS_COLS).difference(df.columns)
     if faltantes:
-        st.error(f"El Excel de Diseños debe tener columnas: {REQUIRED_DESIGNS_COLS}. Encontradas: {list(df.columns)}")
-        st.stop()
+        raise ValueError(f"El Excel de Diseños debe tener columnas: {REQUIRED_DESIGNS_COLS}. Encontradas: {list(df.columns)}")
 
-    tabla_disenos = {}
-    tipos_cortina = {}
-    precios_mo = {}
-    disenos_a_tipos = {}
-
-    for _, row in df.iterrows():
-        dis = str(row["Diseño"]).strip()
-        tipos = [t.strip() for t in str(row["Tipo"]).split(",") if str(t).strip()]
-        mult = _safe_float(row["Multiplicador"], 1.0)
-        mo_val = _safe_float(row["PVP M.O."], 0.0)
-
-        # --- VERSIÓN CORREGIDA DEL ERROR DE SINTAXIS ---
-        tabla_disenos[dis] = mult
-        precios_mo[f"M.O: {dis}"] = {"unidad": "MT", "pvp": mo_val}
-        disenos_a_tipos.setdefault(dis, [])
-        # --- FIN DE LA CORRECIÓN ---
-
-        for t in tipos:
-            tipos_cortina.setdefault(t, [])
-            if dis not in tipos_cortina[t]:
-                tipos_cortina[t].append(dis)
-            if t not in disenos_a_tipos[dis]:
-                disenos_a_tipos[dis].append(t)
-
-    return tabla_disenos, tipos_cortina, precios_mo, disenos_a_tipos, df
-
-@st.cache_data(show_spinner="Cargando BOM...")
-def load_bom_from_excel(path: str):
-    if not os.path.exists(path):
-        st.error(f"No se encontró el archivo Excel de BOM en: {path}")
-        st.stop()
-    df = pd.read_excel(path, engine="openpyxl")
+    df["Diseño"] = _clean_str_col(df["Diseño"])
+    df["Multiplicador"] = _num_col(df["Multiplicador"], 1.0)
+    df["PVP M.O."] = _num_col(df["PVP M.O."], 0.0)
+
+    tabla_disenos = dict(zip(df["Diseño"], df["Multiplicador"]))
+    precios_mo = {f"M.O: {dis}": {"unidad": "MT", "pvp": mo_val} for dis, mo_val in zip(df["Diseño"], df["PVP M.O."])}
+
+    # Una fila por (Diseño, Tipo); dict.fromkeys quita duplicados conservando el orden del Excel
+    exp = df.assign(_t=df["Tipo"].fillna("").astype(str).str.split(",")).explode("_t")
+    exp["_t"] = exp["_t"].str.strip()
+    exp = exp[exp["_t"] != ""]
+    tipos_cortina = exp.groupby("_t", sort=False)["Diseño"].apply(lambda s: list(dict.fromkeys(s))).to_dict()
+    disenos_a_tipos = {dis: [] for dis in df["Diseño"]}
+    disenos_a_tipos.update(exp.groupby("Diseño", sort=False)["_t"].apply(lambda s: list(dict.fromkeys(s))).to_dict())
+
+    return tabla_disenos, tipos_cortina, precios_mo, disenos_a_tipos
+
+@st.cache_resource(show_spinner="Cargando BOM...", max_entries=1)
+def _parse_bom(path: str, stamp):
+    df = _read_excel(path, stamp, REQUIRED_BOM_COLS, text_cols=("Diseño", "Insumo", "Unidad", "ReglaCantidad", "DependeDeSeleccion", "Observaciones"))
     
-    faltantes = [c for c in REQUIRED_BOM_COLS if c not in df.columns]
+    faltantes = set(REQUIRED_BOM_COLS).difference(df.columns)
     if faltantes:
-        st.error(f"El Excel de BOM debe tener columnas: {REQUIRED_BOM_COLS}. Encontradas: {list(df.columns)}")
-        st.stop()
+        raise ValueError(f"El Excel de BOM debe tener columnas: {REQUIRED_BOM_COLS}. Encontradas: {list(df.columns)}")
 
-    reglas_invalidas = sorted(set(str(x).strip().upper() for x in df["ReglaCantidad"]) - ALLOWED_RULES)
+    df["ReglaCantidad"] = _clean_str_col(df["ReglaCantidad"], upper=True)
+    reglas_invalidas = sorted(df.loc[~df["ReglaCantidad"].isin(ALLOWED_RULES), "ReglaCantidad"].unique())
     if reglas_invalidas:
-        st.error("Reglas no soportadas en 'ReglaCantidad': " + ", ".join(reglas_invalidas))
-        st.stop()
-
-    bom_dict = {}
-    for _, row in df.iterrows():
-        p_raw = row.get("Parametro", "")
-        param_norm = "" if pd.isna(p_raw) or (isinstance(p_raw, str) and p_raw.strip().lower() in ("", "nan", "none")) else str(p_raw).strip()
-
-        item = {
-            "Insumo": str(row["Insumo"]).strip(),
-            "Unidad": str(row["Unidad"]).strip().upper(),
-            "ReglaCantidad": str(row["ReglaCantidad"]).strip().upper(),
-            "Parametro": param_norm,
-            "DependeDeSeleccion": str(row["DependeDeSeleccion"]).strip().upper(),
-            "Observaciones": "" if pd.isna(row.get("Observaciones", "")) else str(row.get("Observaciones", "")),
+        # Una celda en blanco queda como "": se muestra explícitamente para que se pueda ubicar la fila
+        raise ValueError("Reglas no soportadas en 'ReglaCantidad': " + ", ".join(r or "(vacía)" for r in reglas_invalidas))
+
+    df["Diseño"] = _clean_str_col(df["Diseño"])
+    df["Insumo"] = _clean_str_col(df["Insumo"])
+    df["Unidad"] = _clean_str_col(df["Unidad"], upper=True)
+    df["DependeDeSeleccion"] = _clean_str_col(df["DependeDeSeleccion"], upper=True)
+    df["Observaciones"] = df["Observaciones"].fillna("").astype(str)
+    df["Parametro"] = _clean_str_col(df["Parametro"])
+    df.loc[df["Parametro"].str.lower().isin(("nan", "none")), "Parametro"] = ""
+    df["ParametroNum"] = _num_col(df["Parametro"], df["ReglaCantidad"].map(_RULE_DEFAULTS))
+    df["Clave"] = df["Insumo"].str.upper()
+
+    # Agrupa por diseño en una sola pasada, conservando el orden de las filas del Excel
+    bom_dict = defaultdict(list)
+    for dis, *campos in df[REQUIRED_BOM_COLS + ["ParametroNum", "Clave"]].itertuples(index=False, name=None):
+        bom_dict[dis].append(BomItem(*campos))
+    bom_dict = dict(bom_dict)
+
+    # Datos derivados por diseño que la UI consulta en cada rerun
+    bom_meta = {
+        dis: {
+            "items_si": [it for it in items if it.depende == "SI"],
+            "usa_tela2": any(it.clave == "TELA 2" for it in items),
         }
-        dis = str(row["Diseño"]).strip()
-        bom_dict.setdefault(dis, []).append(item)
-    return bom_dict, df
+        for dis, items in bom_dict.items()
+    }
+    return bom_dict, bom_meta
 
-@st.cache_data(show_spinner="Cargando catálogo de insumos...")
-def load_catalog_from_excel(path: str):
-    if not os.path.exists(path):
-        st.warning(f"No se encontró el catálogo de insumos en: {path}. Solo se usarán TELA 1/2 y M.O.")
-        return {}
-    df = pd.read_excel(path, engine="openpyxl")
+@st.cache_resource(show_spinner="Cargando catálogo de insumos...", max_entries=1)
+def _parse_catalog(path: str, stamp):
+    df = _read_excel(path, stamp, REQUIRED_CAT_COLS, text_cols=("Insumo", "Unidad", "Ref", "Color"))
+    
+    faltantes = set(REQUIRED_CAT_COLS).difference(df.columns)
+    if faltantes:
+        raise ValueError(f"El catálogo debe tener columnas: {REQUIRED_CAT_COLS}. Encontradas: {list(df.columns)}")
+
+    for c in ("Insumo", "Ref", "Color"):
+        df[c] = _clean_str_col(df[c])
+    df["Unidad"] = _clean_str_col(df["Unidad"], upper=True)
+    df["PVP"] = _num_col(df["PVP"], 0.0)
+
+    catalog = defaultdict(lambda: {"unidad": "", "refs": [], "by_ref": defaultdict(lambda: {"colors": [], "by_color": {}})})
+    for insumo, unidad, ref, color, pvp in df[REQUIRED_CAT_COLS].itertuples(index=False, name=None):
+        cat = catalog[insumo]
+        if not cat["unidad"]:
+            cat["unidad"] = unidad
+        # Índice ref -> color -> pvp; si un (ref, color) se repite, gana la primera fila
+        por_ref = cat["by_ref"][ref]
+        if color not in por_ref["by_color"]:
+            por_ref["colors"].append(color)
+            por_ref["by_color"][color] = pvp
+    for cat in catalog.values():
+        cat["by_ref"] = dict(cat["by_ref"])
+        cat["refs"] = sorted(cat["by_ref"])
+        for por_ref in cat["by_ref"].values():
+            por_ref["colors"].sort()
+    # Dicts normales: un defaultdict compartido crearía entradas al consultar claves inexistentes
+    return dict(catalog)
+
+@st.cache_resource(show_spinner="Cargando catálogo de telas...", max_entries=1)
+def _parse_telas(path: str, stamp):
+    df = _read_excel(path, stamp, REQUIRED_TELAS_COLS, text_cols=("TipoTela", "Referencia", "Color"))
     
-    faltantes = [c for c in REQUIRED_CAT_COLS if c not in df.columns]
+    faltantes = set(REQUIRED_TELAS_COLS).difference(df.columns)
     if faltantes:
-        st.error(f"El catálogo debe tener columnas: {REQUIRED_CAT_COLS}. Encontradas: {list(df.columns)}")
+        raise ValueError(f"El catálogo de telas debe tener columnas: {REQUIRED_TELAS_COLS}. Encontradas: {list(df.columns)}")
+
+    for c in ("TipoTela", "Referencia", "Color"):
+        df[c] = _clean_str_col(df[c])
+    df["PVP/Metro ($)"] = _num_col(df["PVP/Metro ($)"], 0.0)
+
+    telas = defaultdict(lambda: defaultdict(lambda: {"colors": [], "by_color": {}}))
+    for tipo, ref, color, pvp in df[REQUIRED_TELAS_COLS].itertuples(index=False, name=None):
+        # colors conserva el orden del Excel; by_color da el PVP sin recorrer la lista
+        entry = telas[tipo][ref]
+        if color not in entry["by_color"]:
+            entry["colors"].append(color)
+            entry["by_color"][color] = pvp
+    # Misma forma que el catálogo de insumos: refs listas para el selectbox + índice por ref
+    return {tipo: {"refs": list(by_ref), "by_ref": dict(by_ref)} for tipo, by_ref in telas.items()}
+
+def load_designs_from_excel(path: str):
+    stamp = _file_stamp(path)
+    if stamp is None:
+        st.error(f"No se encontró el archivo Excel de Diseños en: {path}")
         st.stop()
+    return _load_or_stop(_parse_designs, path, stamp)
 
-    catalog = {}
-    for _, row in df.iterrows():
-        insumo, unidad, ref, color, pvp = str(row["Insumo"]).strip(), str(row["Unidad"]).strip().upper(), str(row["Ref"]).strip(), str(row["Color"]).strip(), _safe_float(row["PVP"], 0.0)
-        catalog.setdefault(insumo, {"unidad": unidad, "opciones": []})
-        if not catalog[insumo].get("unidad"):
-            catalog[insumo]["unidad"] = unidad
-        catalog[insumo]["opciones"].append({"ref": ref, "color": color, "pvp": pvp})
-    return catalog
+def load_bom_from_excel(path: str):
+    stamp = _file_stamp(path)
+    if stamp is None:
+        st.error(f"No se encontró el archivo Excel de BOM en: {path}")
+        st.stop()
+    return _load_or_stop(_parse_bom, path, stamp)
+
+def load_catalog_from_excel(path: str):
+    stamp = _file_stamp(path)
+    if stamp is None:
+        st.warning(f"No se encontró el catálogo de insumos en: {path}. Solo se usarán TELA 1/2 y M.O.")
+        return {}
+    return _load_or_stop(_parse_catalog, path, stamp)
 
-@st.cache_data(show_spinner="Cargando catálogo de telas...")
 def load_telas_from_excel(path: str):
-    if not os.path.exists(path):
+    stamp = _file_stamp(path)
+    if stamp is None:
         st.error(f"No se encontró el archivo Excel de Telas en: {path}")
         st.stop()
-    df = pd.read_excel(path, engine="openpyxl")
-    
-    faltantes = [c for c in REQUIRED_TELAS_COLS if c not in df.columns]
-    if faltantes:
-        st.error(f"El catálogo de telas debe tener columnas: {REQUIRED_TELAS_COLS}. Encontradas: {list(df.columns)}")
-        st.stop()
-
-    telas = {}
-    for _, row in df.iterrows():
-        tipo, ref, color, pvp = str(row["TipoTela"]).strip(), str(row["Referencia"]).strip(), str(row["Color"]).strip(), _safe_float(row["PVP/Metro ($)"], 0.0)
-        telas.setdefault(tipo, {})
-        telas[tipo].setdefault(ref, [])
-        telas[tipo][ref].append({"color": color, "pvp": pvp})
-    return telas
+    return _load_or_stop(_parse_telas, path, stamp)
 
 # =======================
 # PDF Class y Funciones
 # =======================
-class PDF(FPDF):
-    def header(self):
-        try:
-            logo_path = os.path.join(SCRIPT_DIR, "logo.png")
-            self.image(logo_path, 10, 8, 33)
-        except Exception:
-            pass
-        R, G, B = 30, 38, 59
-        self.set_xy(45, 17); self.set_font('Arial', 'B', 14); self.set_text_color(R, G, B); self.cell(0, 10, 'Almacén Legal', 0, 1)
-        self.set_xy(45, 25); self.set_font('Arial', 'B', 24); self.cell(0, 10, 'COTIZACIÓN', 0, 1)
-        meses = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-        fecha_actual = datetime.now()
-        fecha_valor = f"{meses[fecha_actual.month - 1]} {fecha_actual.day}, {fecha_actual.year}"
-        self.set_xy(45, 35); self.set_text_color(R, G, B); self.set_font('Arial', 'B', 10)
-        etiqueta = "Fecha: "; ancho_etiqueta = self.get_string_width(etiqueta) + 1
-        self.cell(ancho_etiqueta, 5, etiqueta, 0, 0, 'L'); self.set_font('Arial', '', 10); self.cell(0, 5, fecha_valor, 0, 1, 'L')
-        self.ln(10)
-
-    def footer(self):
-        self.set_y(-15); self.set_font('Arial', 'I', 8); self.set_text_color(128); self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'R')
-
-def generar_pdf_cotizacion():
-    pdf = PDF(); pdf.alias_nb_pages(); pdf.add_page(); pdf.set_auto_page_break(auto=True, margin=15)
-    vendedor = st.session_state.datos_cotizacion.get('vendedor', {}); cliente = st.session_state.datos_cotizacion.get('cliente', {})
+# Datos fijos del encabezado: se arman una vez y no en cada página del PDF
+_LOGO_PATH = os.path.join(SCRIPT_DIR, "logo.png")
+_LOGO_ANCHO_MM = 33
+_MESES = ("Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre")
+
+@st.cache_resource(show_spinner=False)
+def _logo_pdf():
+    # El PNG se decodifica una sola vez por proceso y se reduce a ~300 dpi para el ancho que ocupa
+    # en el PDF: el original (1024 px) se volvía a leer y comprimir en cada documento.
+    from PIL import Image
+    lado = round(_LOGO_ANCHO_MM / 25.4 * 300)
+    with Image.open(_LOGO_PATH) as im:
+        im.thumbnail((lado, lado), Image.LANCZOS)
+        return im.copy()
+
+@st.cache_resource(show_spinner=False)
+def _pdf_class():
+    # fpdf solo se importa la primera vez que se genera un PDF, no en cada arranque de la app
+    from fpdf import FPDF
+
+    class PDF(FPDF):
+        def header(self):
+            try:
+                self.image(_logo_pdf(), 10, 8, _LOGO_ANCHO_MM)
+            except Exception:
+                pass
+            R, G, B = 30, 38, 59
+            self.set_xy(45, 17); self.set_font('Helvetica', 'B', 14); self.set_text_color(R, G, B); self.cell(0, 10, 'Almacén Legal', new_x="LMARGIN", new_y="NEXT")
+            self.set_xy(45, 25); self.set_font('Helvetica', 'B', 24); self.cell(0, 10, 'COTIZACIÓN', new_x="LMARGIN", new_y="NEXT")
+            self.set_xy(45, 35); self.set_text_color(R, G, B); self.set_font('Helvetica', 'B', 10)
+            etiqueta = "Fecha: "; ancho_etiqueta = self.get_string_width(etiqueta) + 1
+            self.cell(ancho_etiqueta, 5, etiqueta, align='L'); self.set_font('Helvetica', '', 10); self.cell(0, 5, self.fecha_valor, new_x="LMARGIN", new_y="NEXT", align='L')
+            self.ln(10)
+
+        def footer(self):
+            self.set_y(-15); self.set_font('Helvetica', 'I', 8); self.set_text_color(128); self.cell(0, 10, f'Página {self.page_no()}', align='R')
+
+    return PDF
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _pdf_cotizacion_bytes(datos_cotizacion, cortinas_resumen, fecha):
+    # Memorizado por contenido (y por fecha, que va en el encabezado): los reruns del resumen
+    # que no cambian la cotización reutilizan los bytes en vez de volver a dibujar el PDF.
+    pdf = _pdf_class()(); pdf.fecha_valor = f"{_MESES[fecha.month - 1]} {fecha.day}, {fecha.year}"; pdf.alias_nb_pages(); pdf.add_page(); pdf.set_auto_page_break(auto=True, margin=15)
+    vendedor = datos_cotizacion.get('vendedor', {}); cliente = datos_cotizacion.get('cliente', {})
     col_w, gap, x_left = 90, 10, pdf.l_margin; x_right = x_left + col_w + gap; y = pdf.get_y()
-    pdf.set_font('Arial', 'B', 12); pdf.set_xy(x_left, y); pdf.cell(col_w, 7, "Cliente:", 0, 0, 'L'); pdf.set_xy(x_right, y); pdf.cell(col_w, 7, "Vendedor:", 0, 1, 'L'); y += 7
+    pdf.set_font('Helvetica', 'B', 12); pdf.set_xy(x_left, y); pdf.cell(col_w, 7, "Cliente:", align='L'); pdf.set_xy(x_right, y); pdf.cell(col_w, 7, "Vendedor:", new_x="LMARGIN", new_y="NEXT", align='L'); y += 7
     def label_value(x, y, label, value, width):
-        value = "" if value is None else str(value); pdf.set_xy(x, y); pdf.set_font('Arial', 'B', 10)
-        lbl = label.strip() + " "; lbl_w = pdf.get_string_width(lbl) + 1; pdf.cell(lbl_w, 5, lbl, 0, 0, 'L'); pdf.set_font('Arial', '', 10)
-        pdf.cell(max(0, width - lbl_w), 5, value, 0, 0, 'L')
+        # Las fuentes core solo cubren latin-1: lo demás se descarta, como hacía el encode('latin-1', 'ignore') de PyFPDF
+        value = "" if value is None else str(value).encode('latin-1', 'ignore').decode('latin-1'); pdf.set_xy(x, y); pdf.set_font('Helvetica', 'B', 10)
+        lbl = label.strip() + " "; lbl_w = pdf.get_string_width(lbl) + 1; pdf.cell(lbl_w, 5, lbl, align='L'); pdf.set_font('Helvetica', '', 10)
+        pdf.cell(max(0, width - lbl_w), 5, value, align='L')
     label_value(x_left, y, "Nombre:", cliente.get('nombre', 'N/A'), col_w); label_value(x_right, y, "Nombre:", vendedor.get('nombre', 'N/A'), col_w); y += 5
     label_value(x_left, y, "Teléfono:", cliente.get('telefono', 'N/A'), col_w); label_value(x_right, y, "Teléfono:", vendedor.get('telefono', 'N/A'), col_w); y += 5
-    label_value(x_left, y, "Cédula:", cliente.get('cedula', 'N/A'), col_w); pdf.set_xy(x_right, y); pdf.cell(col_w, 5, "", 0, 1, 'L'); y += 7; pdf.set_y(y); pdf.ln(3)
+    label_value(x_left, y, "Cédula:", cliente.get('cedula', 'N/A'), col_w); pdf.set_xy(x_right, y); pdf.cell(col_w, 5, "", new_x="LMARGIN", new_y="NEXT", align='L'); y += 7; pdf.set_y(y); pdf.ln(3)
     # (El resto de la lógica del PDF sigue aquí sin cambios...)
-    return pdf.output(dest='S').encode('latin-1', 'ignore')
+    return bytes(pdf.output())
+
+def generar_pdf_cotizacion():
+    # Devuelve un callable para st.download_button: el PDF se arma solo cuando se pulsa el botón, en
+    # otro hilo sin acceso al session_state, así que los datos se capturan aquí.
+    return partial(_pdf_cotizacion_bytes, st.session_state.datos_cotizacion, st.session_state.cortinas_resumen, date.today())
 
 # =======================
 # App State & UI Functions
 # =======================
 st.set_page_config(page_title="Almacén Legal Cotizador", page_icon="logo.png", layout="wide")
 
-TABLA_DISENOS, TIPOS_CORTINA, PRECIOS_MANO_DE_OBRA, DISENOS_A_TIPOS, DF_DISENOS = load_designs_from_excel(DESIGNS_XLSX_PATH)
-BOM_DICT, DF_BOM = load_bom_from_excel(BOM_XLSX_PATH)
+TABLA_DISENOS, TIPOS_CORTINA, PRECIOS_MANO_DE_OBRA, DISENOS_A_TIPOS = load_designs_from_excel(DESIGNS_XLSX_PATH)
+BOM_DICT, BOM_META = load_bom_from_excel(BOM_XLSX_PATH)
 CATALOGO_INSUMOS = load_catalog_from_excel(CATALOG_XLSX_PATH)
 CATALOGO_TELAS = load_telas_from_excel(CATALOG_TELAS_XLSX_PATH)
 
+# Solo lectura: los catálogos no se modifican en tiempo de ejecución, así que se comparten tal cual
+# (sin copias) y cualquier escritura accidental falla de inmediato.
+TABLA_DISENOS, TIPOS_CORTINA, PRECIOS_MANO_DE_OBRA, DISENOS_A_TIPOS = (MappingProxyType(d) for d in (TABLA_DISENOS, TIPOS_CORTINA, PRECIOS_MANO_DE_OBRA, DISENOS_A_TIPOS))
+BOM_DICT, BOM_META = MappingProxyType(BOM_DICT), MappingProxyType(BOM_META)
+CATALOGO_INSUMOS, CATALOGO_TELAS = MappingProxyType(CATALOGO_INSUMOS), MappingProxyType(CATALOGO_TELAS)
+
+# Opciones de los selectbox de diseño y tela, congeladas una vez por ejecución
+TIPO_OPCIONES = tuple(TIPOS_CORTINA)
+TIPO_TELA_OPCIONES = tuple(CATALOGO_TELAS)
+DISENOS_POR_TIPO = MappingProxyType({tipo: tuple(disenos) for tipo, disenos in TIPOS_CORTINA.items()})
+
+# Valores iniciales del session_state; los mutables se copian para que cada sesión tenga los suyos
+_STATE_DEFAULTS = {
+    'pagina_actual': 'cotizador',
+    'datos_cotizacion': {"cliente": {}, "vendedor": {}},
+    'cortinas_resumen': [],
+    'cortina_calculada': None,
+    'last_diseno_sel': None,
+    'cortina_a_editar': None,
+    'editando_index': None,
+}
+
 def init_state():
-    if 'pagina_actual' not in st.session_state: st.session_state.pagina_actual = 'cotizador'
-    if 'datos_cotizacion' not in st.session_state: st.session_state.datos_cotizacion = {"cliente": {}, "vendedor": {}}
-    if 'cortinas_resumen' not in st.session_state: st.session_state.cortinas_resumen = []
-    if 'cortina_calculada' not in st.session_state: st.session_state.cortina_calculada = None
-    if 'last_diseno_sel' not in st.session_state: st.session_state.last_diseno_sel = None
-    if 'cortina_a_editar' not in st.session_state: st.session_state.cortina_a_editar = None
-    if 'editando_index' not in st.session_state: st.session_state.editando_index = None
+    # Las llaves se crean juntas y nunca se borran: si ya existe la primera, la sesión está inicializada
+    if 'pagina_actual' in st.session_state: return
+    for k, v in _STATE_DEFAULTS.items():
+        if k not in st.session_state: st.session_state[k] = copy.deepcopy(v)
 
 def anadir_a_resumen():
     if st.session_state.get('cortina_calculada'):
@@ -316,7 +459,12 @@ def anadir_a_resumen():
         st.session_state.cortina_calculada = None
 
 def duplicar_cortina(index):
-    cortina_duplicada = copy.deepcopy(st.session_state.cortinas_resumen[index])
+    cortina = st.session_state.cortinas_resumen[index]
+    # Solo se copian las ramas mutables conocidas; el resto de valores son escalares
+    cortina_duplicada = dict(cortina)
+    cortina_duplicada["telas"] = {k: (dict(v) if v else v) for k, v in cortina.get("telas", {}).items()}
+    cortina_duplicada["insumos_seleccion"] = {k: dict(v) for k, v in cortina.get("insumos_seleccion", {}).items()}
+    cortina_duplicada["detalle_insumos"] = [dict(d) for d in cortina.get("detalle_insumos", [])]
     st.session_state.cortinas_resumen.append(cortina_duplicada)
     st.success("¡Cortina duplicada y añadida al resumen!")
 
@@ -329,83 +477,93 @@ def sidebar():
         if st.button("Datos de la Cotización", use_container_width=True): st.session_state.pagina_actual = 'datos'; st.rerun()
         if st.button("Ver Cotización", use_container_width=True): st.session_state.pagina_actual = 'resumen'; st.rerun()
 
+def _default_index(options, key: str) -> int:
+    # Índice inicial de un selectbox: la opción guardada en session_state, o la primera si ya no existe
+    valor = st.session_state.get(key)
+    return options.index(valor) if valor in options else 0
+
 def ui_tela(prefix: str):
     tipo_key, ref_key, color_key, pvp_key, modo_key = f"tipo_tela_sel_{prefix}", f"ref_tela_sel_{prefix}", f"color_tela_sel_{prefix}", f"pvp_tela_{prefix}", f"modo_conf_{prefix}"
     if not CATALOGO_TELAS: st.error("No se pudo cargar el catálogo de telas."); return
-    tipo_options = list(CATALOGO_TELAS.keys())
-    tipo_default_idx = tipo_options.index(st.session_state.get(tipo_key, tipo_options[0])) if st.session_state.get(tipo_key) in tipo_options else 0
-    tipo = st.selectbox(f"Tipo de Tela {prefix}", options=tipo_options, key=tipo_key, index=tipo_default_idx)
+    tipo_default_idx = _default_index(TIPO_TELA_OPCIONES, tipo_key)
+    tipo = st.selectbox(f"Tipo de Tela {prefix}", options=TIPO_TELA_OPCIONES, key=tipo_key, index=tipo_default_idx)
     if not tipo or tipo not in CATALOGO_TELAS: st.warning(f"No hay tipos de tela disponibles."); return
-    referencias = list(CATALOGO_TELAS[tipo].keys())
-    ref_default_idx = referencias.index(st.session_state.get(ref_key, referencias[0])) if st.session_state.get(ref_key) in referencias else 0
+    tela = CATALOGO_TELAS[tipo]
+    referencias = tela["refs"]
+    ref_default_idx = _default_index(referencias, ref_key)
     ref = st.selectbox(f"Referencia {prefix}", options=referencias, key=ref_key, index=ref_default_idx)
-    if not ref or ref not in CATALOGO_TELAS[tipo]: st.warning(f"No hay referencias disponibles para el tipo '{tipo}'."); return
-    colores = [x["color"] for x in CATALOGO_TELAS[tipo][ref]]
-    color_default_idx = colores.index(st.session_state.get(color_key, colores[0])) if st.session_state.get(color_key) in colores else 0
+    if not ref or ref not in tela["by_ref"]: st.warning(f"No hay referencias disponibles para el tipo '{tipo}'."); return
+    por_ref = tela["by_ref"][ref]
+    colores = por_ref["colors"]
+    color_default_idx = _default_index(colores, color_key)
     color = st.selectbox(f"Color {prefix}", options=colores, key=color_key, index=color_default_idx)
     if not color: st.warning("No hay colores disponibles."); return
-    info = next((x for x in CATALOGO_TELAS[tipo][ref] if x["color"] == color), None)
-    if info: st.session_state[pvp_key] = info["pvp"]; st.text_input(f"PVP/Metro TELA {prefix} ($)", value=f"${int(info['pvp']):,}", disabled=True)
+    pvp = por_ref["by_color"].get(color)
+    if pvp is not None: st.session_state[pvp_key] = pvp; st.text_input(f"PVP/Metro TELA {prefix} ($)", value=_fmt_money(pvp), disabled=True)
     else: st.warning("Información de precio no encontrada."); st.session_state[pvp_key] = 0.0
     modo_options = ["Entera", "Partida", "Semipartida"]
-    modo_default_idx = modo_options.index(st.session_state.get(modo_key, "Entera")) if st.session_state.get(modo_key) in modo_options else 0
+    modo_default_idx = _default_index(modo_options, modo_key)
     st.radio(f"Modo de confección {prefix}", options=modo_options, horizontal=True, key=modo_key, index=modo_default_idx)
 
 def mostrar_insumos_bom(diseno_sel: str):
-    items = [it for it in BOM_DICT.get(diseno_sel, []) if it["DependeDeSeleccion"] == "SI"]
+    items = BOM_META.get(diseno_sel, {}).get("items_si", [])
     if not items: st.info("Este diseño no requiere insumos adicionales para seleccionar."); return
     for item in items:
-        nombre, unidad = item["Insumo"], item["Unidad"]
+        nombre, unidad = item.insumo, item.unidad
         with st.container(border=True):
             st.markdown(f"**Insumo:** {nombre}  •  **Unidad:** {unidad}")
             if nombre in CATALOGO_INSUMOS:
                 cat = CATALOGO_INSUMOS[nombre]
-                refs = sorted(list({opt['ref'] for opt in cat['opciones']}))
+                refs = cat['refs']
                 ref_key, color_key = f"ref_{nombre}", f"color_{nombre}"
-                ref_default_idx = refs.index(st.session_state.get(ref_key, refs[0])) if st.session_state.get(ref_key) in refs else 0
+                ref_default_idx = _default_index(refs, ref_key)
                 ref_sel = st.selectbox(f"Referencia {nombre}", options=refs, key=ref_key, index=ref_default_idx)
-                colores = sorted(list({opt['color'] for opt in cat['opciones'] if opt['ref'] == ref_sel}))
-                color_default_idx = colores.index(st.session_state.get(color_key, colores[0])) if st.session_state.get(color_key) in colores else 0
+                por_ref = cat['by_ref'][ref_sel]
+                colores = por_ref['colors']
+                color_default_idx = _default_index(colores, color_key)
                 color_sel = st.selectbox(f"Color {nombre}", options=colores, key=color_key, index=color_default_idx)
-                insumo_info = next(opt for opt in cat['opciones'] if opt['ref'] == ref_sel and opt['color'] == color_sel)
-                st.text_input(f"P.V.P {nombre} ({cat['unidad']})", value=f"${int(insumo_info['pvp']):,}", disabled=True)
+                pvp = por_ref['by_color'][color_sel]
+                st.text_input(f"P.V.P {nombre} ({cat['unidad']})", value=_fmt_money(pvp), disabled=True)
                 st.session_state.setdefault("insumos_seleccion", {})
-                st.session_state.insumos_seleccion[nombre] = {"ref": ref_sel, "color": color_sel, "pvp": insumo_info["pvp"], "unidad": cat["unidad"]}
+                st.session_state.insumos_seleccion[nombre] = {"ref": ref_sel, "color": color_sel, "pvp": pvp, "unidad": cat["unidad"]}
             else: st.warning(f"{nombre}: marcado como 'DependeDeSeleccion' pero no está en el Catálogo de Insumos.")
 
-def calcular_y_mostrar_cotizacion():
-    diseno = st.session_state.diseno_sel
-    ancho = _safe_float(st.session_state.ancho, 0.0); alto = _safe_float(st.session_state.alto, 0.0)
-    multiplicador = _safe_float(st.session_state.multiplicador, 1.0); num_cortinas = int(st.session_state.cantidad)
+@st.cache_data(show_spinner=False, max_entries=256)
+def _calcular_detalle(items, mo_key, mo_info, ancho, multiplicador, num_cortinas, tela1, tela2, insumos_seleccion):
+    # Cálculo puro (sin session_state): se memoriza por sus entradas. tela1/tela2 = (pvp, ref, color)
     detalle_insumos, subtotal = [], 0.0
-    for item in BOM_DICT.get(diseno, []):
-        nombre, unidad, regla, param = item["Insumo"].strip().upper(), item["Unidad"].upper(), item["ReglaCantidad"].upper(), item["Parametro"]
-        if regla == "MT_ANCHO_X_MULT": cantidad = ancho * multiplicador * _safe_float(param, 1.0)
-        elif regla == "UND_OJALES_PAR": cantidad = ceil_to_even((ancho * multiplicador) / _safe_float(param, DISTANCIA_OJALES_DEF))
-        elif regla == "UND_BOTON_PAR": cantidad = ceil_to_even((ancho * multiplicador) / _safe_float(param, DISTANCIA_BOTON_DEF))
-        elif regla == "FIJO": cantidad = _safe_float(param, 0.0)
-        else: st.error(f"ReglaCantidad '{regla}' no soportada."); st.stop()
+    for item in items:
+        nombre, unidad, regla, param = item.clave, item.unidad, item.regla, item.parametro_num
+        # _parse_bom ya rechazó las reglas fuera de ALLOWED_RULES: la llave siempre existe
+        cantidad = _RULE_FNS[regla](ancho, multiplicador, param)
         cantidad_total = cantidad * num_cortinas
         if nombre == "TELA 1":
-            pvp = _safe_float(st.session_state.get("pvp_tela_1"), 0.0); ref = st.session_state.get("ref_tela_sel_1", ""); color = st.session_state.get("color_tela_sel_1", "")
+            pvp, ref, color = tela1
             nombre_mostrado, uni = f"TELA 1: {ref} - {color}", "MT"
         elif nombre == "TELA 2":
-            pvp = _safe_float(st.session_state.get("pvp_tela_2"), 0.0); ref = st.session_state.get("ref_tela_sel_2", ""); color = st.session_state.get("color_tela_sel_2", "")
+            pvp, ref, color = tela2
             nombre_mostrado, uni = f"TELA 2: {ref} - {color}", "MT"
         elif nombre.startswith("M.O"): continue
         else:
-            sel = st.session_state.get("insumos_seleccion", {}).get(item["Insumo"], {})
-            pvp, uni, nombre_mostrado = _safe_float(sel.get("pvp"), 0.0), sel.get("unidad", unidad), item["Insumo"]
+            sel = insumos_seleccion.get(item.insumo, {})
+            pvp, uni, nombre_mostrado = _safe_float(sel.get("pvp"), 0.0), sel.get("unidad", unidad), item.insumo
         precio_total = pvp * cantidad_total; subtotal += precio_total
         detalle_insumos.append({"Insumo": nombre_mostrado, "Unidad": uni, "Cantidad": round(cantidad_total, 2) if uni != "UND" else int(round(cantidad_total)), "P.V.P/Unit ($)": pvp, "Precio ($)": round(precio_total)})
-    mo_key_candidates = [f"M.O: {diseno}", f"M.O. {diseno}"]; mo_info, mo_key = None, None
-    for k in mo_key_candidates:
-        if k in PRECIOS_MANO_DE_OBRA: mo_key = k; mo_info = PRECIOS_MANO_DE_OBRA[k]; break
     if mo_info and _safe_float(mo_info.get("pvp"), 0) > 0:
         cant_mo, pvp_mo = ancho * multiplicador * num_cortinas, _safe_float(mo_info["pvp"], 0.0)
         precio_mo = round(cant_mo * pvp_mo); subtotal += precio_mo
         detalle_insumos.append({"Insumo": mo_key, "Unidad": mo_info.get("unidad", "MT"), "Cantidad": round(cant_mo, 2), "P.V.P/Unit ($)": pvp_mo, "Precio ($)": precio_mo})
     total = round(subtotal); iva = round(total * IVA_PERCENT / (1 + IVA_PERCENT)); subtotal_sin_iva = total - iva
+    return detalle_insumos, subtotal_sin_iva, iva, total
+
+def calcular_y_mostrar_cotizacion():
+    diseno = st.session_state.diseno_sel
+    ancho = _safe_float(st.session_state.ancho, 0.0); alto = _safe_float(st.session_state.alto, 0.0)
+    multiplicador = _safe_float(st.session_state.multiplicador, 1.0); num_cortinas = int(st.session_state.cantidad)
+    # _parse_designs escribe siempre la llave como "M.O: <diseño>"
+    mo_key = f"M.O: {diseno}"; mo_info = PRECIOS_MANO_DE_OBRA.get(mo_key)
+    tela1, tela2 = [(_safe_float(st.session_state.get(f"pvp_tela_{n}"), 0.0), st.session_state.get(f"ref_tela_sel_{n}", ""), st.session_state.get(f"color_tela_sel_{n}", "")) for n in (1, 2)]
+    detalle_insumos, subtotal_sin_iva, iva, total = _calcular_detalle(BOM_DICT.get(diseno, []), mo_key, mo_info, ancho, multiplicador, num_cortinas, tela1, tela2, st.session_state.get("insumos_seleccion", {}))
     tela_info = {"tela1": {"tipo": st.session_state.get("tipo_tela_sel_1", ""), "referencia": st.session_state.get("ref_tela_sel_1", ""), "color": st.session_state.get("color_tela_sel_1", ""), "pvp": _safe_float(st.session_state.get("pvp_tela_1"), 0.0), "modo_confeccion": st.session_state.get("modo_conf_1", "")}}
     if st.session_state.get("pvp_tela_2") is not None:
         tela_info["tela2"] = {"tipo": st.session_state.get("tipo_tela_sel_2", ""), "referencia": st.session_state.get("ref_tela_sel_2", ""), "color": st.session_state.get("color_tela_sel_2", ""), "pvp": _safe_float(st.session_state.get("pvp_tela_2"), 0.0), "modo_confeccion": st.session_state.get("modo_conf_2", "")}
@@ -454,7 +612,7 @@ def pantalla_resumen():
 
                 with col_img:
                     image_path = get_image_path_for_summary(diseno, cortina.get('telas', {}).get('tela1'))
-                    if os.path.exists(image_path):
+                    if image_path:
                         st.image(image_path, use_container_width=True)
                 
                 with col_details:
@@ -485,14 +643,13 @@ def pantalla_resumen():
                     st.markdown(f"**Medidas:** {medidas_str} (*{modo_conf}*)")
 
                     # Fila 3: Precio
-                    st.title(f"${int(total):,}")
+                    st.title(_fmt_money(total))
 
                     # Fila 4: Divisor
                     st.markdown("---")
 
                     # Fila 5: Lista de Insumos
-                    df_insumos = pd.DataFrame(cortina.get('detalle_insumos', []))
-                    for _, row in df_insumos.iterrows():
+                    for row in cortina.get('detalle_insumos', []):
                         st.text(f"{row['Cantidad']} {row['Unidad']} - {row['Insumo']}")
 
     if index_a_eliminar is not None:
@@ -503,23 +660,21 @@ def pantalla_resumen():
     st.markdown("---")
     st.subheader("Totales de la Cotización")
 
-    # CORRECCIÓN DEL ERROR: Se añade 'if c' para ignorar posibles ítems nulos
-    # y .get(key, 0) para manejar casos donde falte un valor.
-    subtotal_total = sum(c.get('subtotal', 0) for c in st.session_state.cortinas_resumen if c)
-    iva_total = sum(c.get('iva', 0) for c in st.session_state.cortinas_resumen if c)
-    gran_total = sum(c.get('total', 0) for c in st.session_state.cortinas_resumen if c)
+    # Una sola pasada; se ignoran ítems nulos con 'if c' y las llaves faltantes cuentan como 0.
+    subtotal_total = iva_total = gran_total = 0
+    for c in st.session_state.cortinas_resumen:
+        if c: subtotal_total += c.get('subtotal', 0); iva_total += c.get('iva', 0); gran_total += c.get('total', 0)
 
     c1, c2, c3 = st.columns(3)
-    c1.metric("Subtotal General", f"${int(subtotal_total):,}")
-    c2.metric("IVA General", f"${int(iva_total):,}")
-    c3.metric("Gran Total", f"${int(gran_total):,}")
+    c1.metric("Subtotal General", _fmt_money(subtotal_total))
+    c2.metric("IVA General", _fmt_money(iva_total))
+    c3.metric("Gran Total", _fmt_money(gran_total))
 
     st.markdown("---")
     
-    pdf_bytes = generar_pdf_cotizacion()
     st.download_button(
         label="📄 Descargar Cotización en PDF",
-        data=pdf_bytes,
+        data=generar_pdf_cotizacion(),
         file_name=f"cotizacion_{st.session_state.datos_cotizacion.get('cliente', {}).get('nombre', 'cliente')}.pdf",
         mime="application/pdf",
         use_container_width=True
@@ -542,16 +697,17 @@ def pantalla_gestion_datos():
 def pantalla_cotizador():
     st.header("Crea la Cortina")
     
-    if 'cortina_a_editar' in st.session_state and st.session_state.cortina_a_editar is not None:
+    if st.session_state.get('cortina_a_editar'):
         cortina_a_editar = st.session_state.cortina_a_editar
         st.subheader("Editando Cortina")
-        st.session_state.update({'ancho': cortina_a_editar['ancho'], 'alto': cortina_a_editar['alto'], 'cantidad': cortina_a_editar['cantidad'], 'multiplicador': cortina_a_editar['multiplicador'], 'tipo_cortina_sel': cortina_a_editar['tipo'], 'diseno_sel': cortina_a_editar['diseno']})
-        if 'tela1' in cortina_a_editar['telas']:
-            st.session_state.update({f"tipo_tela_sel_1": cortina_a_editar['telas']['tela1'].get('tipo'), f"ref_tela_sel_1": cortina_a_editar['telas']['tela1'].get('referencia'), f"color_tela_sel_1": cortina_a_editar['telas']['tela1'].get('color'), f"pvp_tela_1": cortina_a_editar['telas']['tela1'].get('pvp')})
-        if 'tela2' in cortina_a_editar['telas'] and cortina_a_editar['telas']['tela2'] is not None:
-            st.session_state.update({f"tipo_tela_sel_2": cortina_a_editar['telas']['tela2'].get('tipo'), f"ref_tela_sel_2": cortina_a_editar['telas']['tela2'].get('referencia'), f"color_tela_sel_2": cortina_a_editar['telas']['tela2'].get('color'), f"pvp_tela_2": cortina_a_editar['telas']['tela2'].get('pvp')})
-        if 'insumos_seleccion' in cortina_a_editar: st.session_state.insumos_seleccion = cortina_a_editar['insumos_seleccion']
-        st.session_state.cortina_a_editar = None
+        # Todo el estado de la cortina a editar se arma en un dict y se vuelca con un solo update
+        estado = {'ancho': cortina_a_editar['ancho'], 'alto': cortina_a_editar['alto'], 'cantidad': cortina_a_editar['cantidad'], 'multiplicador': cortina_a_editar['multiplicador'], 'tipo_cortina_sel': cortina_a_editar['tipo'], 'diseno_sel': cortina_a_editar['diseno'], 'cortina_a_editar': None}
+        for n in ("1", "2"):
+            tela = cortina_a_editar['telas'].get(f"tela{n}")
+            if tela is not None:
+                estado.update({f"tipo_tela_sel_{n}": tela.get('tipo'), f"ref_tela_sel_{n}": tela.get('referencia'), f"color_tela_sel_{n}": tela.get('color'), f"pvp_tela_{n}": tela.get('pvp')})
+        if 'insumos_seleccion' in cortina_a_editar: estado['insumos_seleccion'] = cortina_a_editar['insumos_seleccion']
+        st.session_state.update(estado)
 
     st.subheader("1. Medidas")
     ancho = st.number_input("Ancho de la Ventana (m)", min_value=0.1, value=st.session_state.get("ancho", 2.0), step=0.1, key="ancho")
@@ -560,13 +716,11 @@ def pantalla_cotizador():
 
     st.markdown("---")
     st.subheader("2. Selecciona el Diseño")
-    tipo_opciones = list(TIPOS_CORTINA.keys())
-    tipo_default_idx = tipo_opciones.index(st.session_state.get("tipo_cortina_sel", tipo_opciones[0])) if st.session_state.get("tipo_cortina_sel") in tipo_opciones else 0
-    tipo_cortina_sel = st.selectbox("Tipo de Cortina", options=tipo_opciones, index=tipo_default_idx, key="tipo_cortina_sel")
-    disenos_disponibles = TIPOS_CORTINA.get(tipo_cortina_sel, [])
+    tipo_default_idx = _default_index(TIPO_OPCIONES, "tipo_cortina_sel")
+    tipo_cortina_sel = st.selectbox("Tipo de Cortina", options=TIPO_OPCIONES, index=tipo_default_idx, key="tipo_cortina_sel")
+    disenos_disponibles = DISENOS_POR_TIPO.get(tipo_cortina_sel, ())
     if not disenos_disponibles: st.error("No hay diseños disponibles para el tipo seleccionado."); st.stop()
-    diseno_previo = st.session_state.get("diseno_sel", disenos_disponibles[0])
-    diseno_default_idx = disenos_disponibles.index(diseno_previo) if diseno_previo in disenos_disponibles else 0
+    diseno_default_idx = _default_index(disenos_disponibles, "diseno_sel")
     diseno_sel = st.selectbox("Diseño", options=disenos_disponibles, index=diseno_default_idx, key="diseno_sel")
     if diseno_sel != st.session_state.get('last_diseno_sel'):
         st.session_state.insumos_seleccion = {}; st.session_state.last_diseno_sel = diseno_sel
@@ -575,8 +729,7 @@ def pantalla_cotizador():
 
     st.markdown("---")
     st.subheader("3. Selecciona la Tela")
-    items_d = BOM_DICT.get(diseno_sel, [])
-    usa_tela2 = any(i["Insumo"].strip().upper() == "TELA 2" for i in items_d)
+    usa_tela2 = BOM_META.get(diseno_sel, {}).get("usa_tela2", False)
     ui_tela("1")
     if usa_tela2:
         st.markdown("—"); ui_tela("2")
@@ -584,7 +737,7 @@ def pantalla_cotizador():
     st.markdown("---")
     st.subheader("Vista Previa")
     image_path = get_image_path("1")
-    if os.path.exists(image_path):
+    if image_path:
         caption = os.path.basename(image_path)
         if "placeholder.png" in caption: caption = "Vista previa no disponible"
         st.image(image_path, caption=caption, use_container_width=True)
@@ -601,15 +754,17 @@ def pantalla_cotizador():
 
     if st.session_state.get('cortina_calculada'):
         st.success("Cálculo realizado. Revisa los detalles a continuación.")
-        df_detalle = pd.DataFrame(st.session_state.cortina_calculada['detalle_insumos'])
-        df_detalle['Vr. Unit'] = df_detalle['P.V.P/Unit ($)'].apply(lambda x: f"${int(x):,}")
-        df_detalle['Vr. Total'] = df_detalle['Precio ($)'].apply(lambda x: f"${int(x):,}")
-        nuevo_orden = ['Cantidad', 'Unidad', 'Insumo', 'Vr. Unit', 'Vr. Total']
-        st.dataframe(df_detalle[nuevo_orden], use_container_width=True, hide_index=True)
+        # Los precios se quedan numéricos; el formato de moneda lo aplica el navegador
+        nuevo_orden = ['Cantidad', 'Unidad', 'Insumo', 'P.V.P/Unit ($)', 'Precio ($)']
+        formato_precios = {
+            'P.V.P/Unit ($)': st.column_config.NumberColumn("Vr. Unit", format="$%,d"),
+            'Precio ($)': st.column_config.NumberColumn("Vr. Total", format="$%,d"),
+        }
+        st.dataframe(st.session_state.cortina_calculada['detalle_insumos'], column_order=nuevo_orden, column_config=formato_precios, use_container_width=True, hide_index=True)
         c1, c2, c3 = st.columns(3)
-        c1.metric("Subtotal Cortina", f"${int(st.session_state.cortina_calculada['subtotal']):,}")
-        c2.metric("IVA Cortina", f"${int(st.session_state.cortina_calculada['iva']):,}")
-        c3.metric("Total Cortina", f"${int(st.session_state.cortina_calculada['total']):,}")
+        c1.metric("Subtotal Cortina", _fmt_money(st.session_state.cortina_calculada['subtotal']))
+        c2.metric("IVA Cortina", _fmt_money(st.session_state.cortina_calculada['iva']))
+        c3.metric("Total Cortina", _fmt_money(st.session_state.cortina_calculada['total']))
         st.markdown("---")
         if st.button("Añadir a la Cotización"):
             anadir_a_resumen()